@@ -6,13 +6,17 @@ from __future__ import absolute_import, print_function
 
 import os
 import hashlib
-from multiprocessing.pool import ThreadPool
-from functools import partial
+import threading
+import plistlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
+from tempfile import SpooledTemporaryFile
 from xml.parsers.expat import ExpatError
 
 from munkilib.munkirepo import Repo, RepoError
 from munkilib.wrappers import get_input
-from munkilib.wrappers import get_input, readPlist, readPlistFromString, writePlistToString, PlistReadError
+from munkilib.wrappers import get_input, writePlistToString
 
 FOUNDATION_SUPPORT = True
 try:
@@ -34,8 +38,37 @@ except ImportError:
 
 __version__ = '1.3'
 BUNDLE_ID = 'com.github.stevekueng.azurerepo'
+# number of parallel ranges the Azure SDK may use per blob transfer
+MAX_CONCURRENCY = int(os.getenv('AZUREREPO_MAX_CONCURRENCY', '8'))
+# global cap on concurrent requests to Azure, across all worker threads,
+# so we stay under the account throttling limits instead of triggering
+# 503/retry storms
+MAX_INFLIGHT = int(os.getenv('AZUREREPO_MAX_INFLIGHT', '32'))
 PREFSNAME = BUNDLE_ID + '.plist'
 PREFSPATH = os.path.expanduser(os.path.join('~/Library/Preferences', PREFSNAME))
+# document wrapper for catalogs assembled from pre-serialized pkginfo
+# fragments (see _plist_fragment)
+PLIST_ARRAY_HEADER = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    b'<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" '
+    b'"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+    b'<plist version="1.0">\n<array>\n')
+PLIST_ARRAY_FOOTER = b'</array>\n</plist>\n'
+# keys and key prefixes never copied from a pkginfo into the catalogs;
+# startswith takes the whole tuple in a single C-level call
+SUPPRESSED_KEY_PREFIXES = ('_',)
+DROPPED_KEYS = {'notes'}
+
+
+def _plist_fragment(plist_object):
+    '''Serializes plist_object to XML and returns just the inner fragment,
+    without the plist document header and footer, so fragments can later be
+    concatenated into a catalog array without keeping the parsed objects
+    in memory.'''
+    data = plistlib.dumps(plist_object)
+    start = data.index(b'\n', data.index(b'<plist')) + 1
+    end = data.rindex(b'</plist>')
+    return data[start:end]
 
 if FOUNDATION_SUPPORT:
     def get_pref(prefname):
@@ -53,21 +86,20 @@ if FOUNDATION_SUPPORT:
             pass
 
 else:
+    @lru_cache(maxsize=1)
+    def _load_prefs():
+        """Reads the preferences plist once and caches the result."""
+        try:
+            with open(PREFSPATH, 'rb') as fileobj:
+                return plistlib.load(fileobj)
+        except (OSError, ExpatError, plistlib.InvalidFileException):
+            return {}
+
     def get_pref(prefname):
         """Returns a preference for prefname. This is a fallback mechanism if
         CoreFoundation functions are not available -- for example to allow the
         possible use of makecatalogs or manifestutil on Linux"""
-        if not hasattr(get_pref, 'cache'):
-            get_pref.cache = None
-        if not get_pref.cache:
-            try:
-                get_pref.cache = readPlist(PREFSPATH)
-            except (IOError, OSError, ExpatError, PlistReadError):
-                get_pref.cache = {}
-        if prefname in get_pref.cache:
-            return get_pref.cache[prefname]
-        # no pref found
-        return None
+        return _load_prefs().get(prefname)
 
 class MakeCatalogsError(Exception):
     '''Error to raise when there is problem making catalogs'''
@@ -102,9 +134,19 @@ class AzureRepo(Repo):
         container_name = os.path.basename(os.path.normpath(self.baseurl))
         self.baseurl = os.path.dirname(self.baseurl)
 
+        # one semaphore gates every request we make to Azure, no matter
+        # which pool or thread issues it
+        self._sem = threading.BoundedSemaphore(MAX_INFLIGHT)
         try:
-            self.blob_client = BlobServiceClient(self.baseurl, credential=sas_token)
+            self.blob_client = BlobServiceClient(self.baseurl, credential=sas_token,
+                                                 retry_total=5,
+                                                 retry_backoff_factor=0.2)
             self.container_client = self.blob_client.get_container_client(container=container_name)
+            # get_blob_client builds a fresh BlobClient (URL parsing,
+            # pipeline wiring) on every call; cache them per blob name so
+            # the makecatalogs hot loops reuse clients
+            self._blob_client = lru_cache(maxsize=8192)(
+                self.container_client.get_blob_client)
             self.container_client.get_account_information()
             print('Connected to Azure Blob Storage')
         except ClientAuthenticationError as e:
@@ -119,54 +161,92 @@ class AzureRepo(Repo):
             set_pref('sas_token', None)
             exit(1)
                  
-    def _process_pkgsinfo(self, pkgsinfo_blob, output_fn=None):
-        '''Processes pkginfo file and returns a dictionary of catalogs'''
-        error = None
-        pkginfo_ref = os.path.basename(pkgsinfo_blob.name)
+    def _process_pkgsinfo(self, pkgsinfo_name, pkgs_set=None, pkgs_lower=None,
+                          options=None, output_fn=None):
+        '''Downloads, parses, verifies and serializes a single pkginfo on a
+        worker thread. Returns (pkginfo_ref, fragment, catalog_names,
+        errors); fragment is None if the pkginfo was skipped or unreadable.'''
+        item_errors = []
+        pkginfo_ref = os.path.basename(pkgsinfo_name)
         # Try to read the pkginfo file
         try:
-            data = self.container_client.get_blob_client(pkgsinfo_blob).download_blob().readall()
-            pkginfo = readPlistFromString(data)
+            # spool the download into a small buffer that spills to disk
+            # for unusually large pkginfos, and let plistlib parse straight
+            # from the file object instead of a second bytes copy.
+            # plistlib uses the C expat parser and auto-detects XML vs
+            # binary plists, which is much faster than the generic wrapper
+            with SpooledTemporaryFile(max_size=65536) as buf:
+                with self._sem:
+                    self._blob_client(pkgsinfo_name).download_blob(max_concurrency=MAX_CONCURRENCY).readinto(buf)
+                buf.seek(0)
+                pkginfo = plistlib.load(buf)
         except BaseException as err:
-            error = "Unexpected error for %s: %s" % (pkginfo_ref, err)
-            return None, None, error
+            item_errors.append(
+                "Unexpected error for %s: %s" % (pkginfo_ref, err))
+            return None, None, [], item_errors
 
         if not 'name' in pkginfo:
-            error = "WARNING: %s is missing name" % pkginfo_ref
-
-        # don't copy admin notes to catalogs.
-        if pkginfo.get('notes'):
-            del pkginfo['notes']
-        # strip out any keys that start with "_"
-        # (example: pkginfo _metadata)
-        for key in list(pkginfo.keys()):
-            if key.startswith('_'):
-                del pkginfo[key]
-
-        return pkginfo_ref, pkginfo, error
+            item_errors.append("WARNING: %s is missing name" % pkginfo_ref)
+
+        # don't copy admin notes to catalogs, and strip out any keys that
+        # start with "_" (example: pkginfo _metadata) -- one rebuild pass
+        # instead of a keys snapshot plus per-key dels
+        pkginfo = {key: value for key, value in pkginfo.items()
+                   if key not in DROPPED_KEYS
+                   and not key.startswith(SUPPRESSED_KEY_PREFIXES)}
+
+        # sanity checking happens here on the worker thread, overlapping
+        # with the remaining downloads instead of draining them first
+        if options and not options.skip_payload_check:
+            if output_fn:
+                output_fn("Verifying %s..." % pkginfo_ref)
+            verified = self._verify_pkginfo(pkginfo_ref, pkginfo,
+                                            pkgs_set, pkgs_lower, item_errors)
+            if not verified and not options.force:
+                # Skip this pkginfo unless we're running with force flag
+                if output_fn:
+                    output_fn("Skipping %s..." % pkginfo_ref)
+                return pkginfo_ref, None, [], item_errors
+
+        catalog_names = pkginfo.get('catalogs', [])
+        fragment = _plist_fragment(pkginfo)
+        return pkginfo_ref, fragment, catalog_names, item_errors
     
-    def _process_icon_hash(self, icon_blob, output_fn=None):
+    def _process_icon_hash(self, icon_blob, cached_hashes=None, output_fn=None):
         '''Processes icon hashes and returns a dictionary'''
         error = None
         icon = None
 
         name = os.path.basename(icon_blob.name)
-        if name == '_icon_hashes.plist':
-            return None, icon, error
+        if name in ('_icon_hashes.plist', '_icon_hashes_cache.plist'):
+            return None, icon, None, error
+        # if the blob's etag matches the one recorded when we last hashed
+        # this icon, the stored hash is still valid -- skip the download
+        cached = (cached_hashes or {}).get(name)
+        if cached and cached.get('etag') == icon_blob.etag:
+            return name, cached.get('sha256'), icon_blob.etag, error
         if output_fn:
             output_fn("Hashing %s..." % (name))
         try:
-            icondata = self.container_client.get_blob_client(icon_blob).download_blob().readall()
+            # stream the blob chunk by chunk instead of buffering the whole
+            # icon in memory before hashing it
+            hasher = hashlib.sha256()
+            with self._sem:
+                stream = self._blob_client(icon_blob.name).download_blob(max_concurrency=MAX_CONCURRENCY)
+                for chunk in stream.chunks():
+                    hasher.update(chunk)
         except BaseException as err:
             error = "Unexpected error for %s: %s" % (name, err)
             print(error)
-            return name, icon, error
-        icon = hashlib.sha256(icondata).hexdigest()
-        return name, icon, error
+            return name, icon, icon_blob.etag, error
+        icon = hasher.hexdigest()
+        return name, icon, icon_blob.etag, error
     
-    def _verify_pkginfo(self, pkginfo_ref, pkginfo, pkgs_list, errors):
+    def _verify_pkginfo(self, pkginfo_ref, pkginfo, pkgs_set, pkgs_lower, errors):
         '''Returns True if referenced installer items are present,
-        False otherwise. Adds errors/warnings to the errors list'''
+        False otherwise. Adds errors/warnings to the errors list.
+        pkgs_set is the set of pkg pathnames in the repo; pkgs_lower maps
+        each lowercased pathname back to its actual case.'''
         installer_type = pkginfo.get('installer_type')
         if installer_type in ['nopkg', 'apple_update_metadata']:
             # no associated installer item (pkg) for these types
@@ -190,22 +270,19 @@ class AzureRepo(Repo):
             return False
 
         # Check if the installer item actually exists
-        if not installeritempath in pkgs_list:
+        if not installeritempath in pkgs_set:
             # do a case-insensitive comparison
-            found_caseinsensitive_match = False
-            for repo_pkg in pkgs_list:
-                if installeritempath.lower() == repo_pkg.lower():
-                    errors.append(
-                        "WARNING: %s refers to installer item: %s. "
-                        "The pathname of the item in the repo has "
-                        "different case: %s. This may cause issues "
-                        "depending on the case-sensitivity of the "
-                        "underlying filesystem."
-                        % (pkginfo_ref,
-                        pkginfo['installer_item_location'], repo_pkg))
-                    found_caseinsensitive_match = True
-                    break
-            if not found_caseinsensitive_match:
+            repo_pkg = pkgs_lower.get(installeritempath.lower())
+            if repo_pkg:
+                errors.append(
+                    "WARNING: %s refers to installer item: %s. "
+                    "The pathname of the item in the repo has "
+                    "different case: %s. This may cause issues "
+                    "depending on the case-sensitivity of the "
+                    "underlying filesystem."
+                    % (pkginfo_ref,
+                    pkginfo['installer_item_location'], repo_pkg))
+            else:
                 errors.append(
                     "WARNING: %s refers to missing installer item: %s"
                     % (pkginfo_ref, pkginfo['installer_item_location']))
@@ -232,22 +309,19 @@ class AzureRepo(Repo):
                 return False
 
             # Check if the uninstaller item actually exists
-            if not uninstalleritempath in pkgs_list:
+            if not uninstalleritempath in pkgs_set:
                 # do a case-insensitive comparison
-                found_caseinsensitive_match = False
-                for repo_pkg in pkgs_list:
-                    if uninstalleritempath.lower() == repo_pkg.lower():
-                        errors.append(
-                            "WARNING: %s refers to uninstaller item: %s. "
-                            "The pathname of the item in the repo has "
-                            "different case: %s. This may cause issues "
-                            "depending on the case-sensitivity of the "
-                            "underlying filesystem."
-                            % (pkginfo_ref,
-                            pkginfo['uninstaller_item_location'], repo_pkg))
-                        found_caseinsensitive_match = True
-                        break
-                if not found_caseinsensitive_match:
+                repo_pkg = pkgs_lower.get(uninstalleritempath.lower())
+                if repo_pkg:
+                    errors.append(
+                        "WARNING: %s refers to uninstaller item: %s. "
+                        "The pathname of the item in the repo has "
+                        "different case: %s. This may cause issues "
+                        "depending on the case-sensitivity of the "
+                        "underlying filesystem."
+                        % (pkginfo_ref,
+                        pkginfo['uninstaller_item_location'], repo_pkg))
+                else:
                     errors.append(
                         "WARNING: %s refers to missing uninstaller item: %s"
                         % (pkginfo_ref, pkginfo['uninstaller_item_location']))
@@ -266,9 +340,9 @@ class AzureRepo(Repo):
         try:
             blob_list = self.container_client.list_blob_names(name_starts_with=kind)
         except ResourceNotFoundError as e:
-            raise('Container (%s) not found. Please check the base url.' % kind)
+            raise RepoError('Container (%s) not found. Please check the base url.' % kind)
         except AzureError as e:
-            raise('Error connecting to Azure: %s' % e)
+            raise RepoError('Error connecting to Azure: %s' % e)
 
         for blob in blob_list:
             name = os.path.relpath(blob, kind)
@@ -283,12 +357,13 @@ class AzureRepo(Repo):
         Avoid using this method with the 'pkgs' kind as it might return a
         really large blob of data.'''
         try:
-            return self.container_client.get_blob_client(resource_identifier).download_blob().readall()
+            with self._sem:
+                return self._blob_client(resource_identifier).download_blob(max_concurrency=MAX_CONCURRENCY).readall()
         except ResourceNotFoundError as e:
             print('Item (%s) not found.' % resource_identifier)
             return None
         except AzureError as e:
-            raise('Error connecting to Azure: %s' % e)
+            raise RepoError('Error connecting to Azure: %s' % e)
 
 
     def get_to_local_file(self, resource_identifier, local_file_path):
@@ -299,22 +374,23 @@ class AzureRepo(Repo):
         <repo_root>/pkgsinfo/apps/Firefox-52.0.plist to a local file given by
         local_file_path.'''
         try:
-            with open(local_file_path, 'wb') as f:
-                self.container_client.get_blob_client(resource_identifier).download_blob().readinto(f)
+            with open(local_file_path, 'wb') as f, self._sem:
+                self._blob_client(resource_identifier).download_blob(max_concurrency=MAX_CONCURRENCY).readinto(f)
         except ResourceNotFoundError as e:
             print('Item (%s) not found.' % resource_identifier)
         except AzureError as e:
-            raise('Error connecting to Azure: %s' % e)
+            raise RepoError('Error connecting to Azure: %s' % e)
 
     def put(self, resource_identifier, content):
         '''Stores content on the repo based on resource_identifier.
         For a file-backed repo, a resource_identifier of
         'pkgsinfo/apps/Firefox-52.0.plist' would result in the content being
         saved to <repo_root>/pkgsinfo/apps/Firefox-52.0.plist.'''
-        try: 
-            self.container_client.upload_blob(name=resource_identifier, data=content, overwrite=True)
+        try:
+            with self._sem:
+                self.container_client.upload_blob(name=resource_identifier, data=content, overwrite=True, max_concurrency=MAX_CONCURRENCY)
         except AzureError as e:
-            raise('Error connecting to Azure: %s' % e)
+            raise RepoError('Error connecting to Azure: %s' % e)
 
     def put_from_local_file(self, resource_identifier, local_file_path):
         '''Copies the content of local_file_path to the repo based on
@@ -322,10 +398,10 @@ class AzureRepo(Repo):
         of 'pkgsinfo/apps/Firefox-52.0.plist' would result in the content
         being saved to <repo_root>/pkgsinfo/apps/Firefox-52.0.plist.'''
         try:
-            with open(local_file_path, 'rb') as f:
-                self.container_client.upload_blob(name=resource_identifier, data=f, overwrite=True)
+            with open(local_file_path, 'rb') as f, self._sem:
+                self.container_client.upload_blob(name=resource_identifier, data=f, overwrite=True, max_concurrency=MAX_CONCURRENCY)
         except AzureError as e:
-            raise('Error connecting to Azure: %s' % e)
+            raise RepoError('Error connecting to Azure: %s' % e)
 
     def delete(self, resource_identifier):
         '''Deletes a repo object located by resource_identifier.
@@ -333,142 +409,204 @@ class AzureRepo(Repo):
         'pkgsinfo/apps/Firefox-52.0.plist' would result in the deletion of
         <repo_root>/pkgsinfo/apps/Firefox-52.0.plist.'''
         try:
-            self.container_client.delete_blob(resource_identifier)
+            with self._sem:
+                self.container_client.delete_blob(resource_identifier)
         except ResourceNotFoundError as e:
             print('Item (%s) not found.' % resource_identifier)
         except AzureError as e:
-            raise('Error connecting to Azure: %s' % e)
-        
+            raise RepoError('Error connecting to Azure: %s' % e)
+
+    def delete_many(self, resource_identifiers):
+        '''Deletes multiple repo objects located by resource_identifiers.
+        Uses the blob batch API, which deletes up to 256 blobs per request
+        instead of one HTTPS round-trip per blob.'''
+        resource_identifiers = list(resource_identifiers)
+        try:
+            for index in range(0, len(resource_identifiers), 256):
+                with self._sem:
+                    self.container_client.delete_blobs(
+                        *resource_identifiers[index:index + 256])
+        except AzureError as e:
+            raise RepoError('Error connecting to Azure: %s' % e)
+
+
     def makecatalogs(self, options, output_fn=None):
         '''Calls makecatalogs with options and output_fn.'''
         errors = []
         
         # read all icons
+        # we need the full BlobProperties here: the etag tells us whether a
+        # previously computed hash is still valid
         try:
             blob_list = self.container_client.list_blobs(name_starts_with='icons')
         except ResourceNotFoundError as e:
-            raise('Container icons not found. Please check the base url.')
-        except AzureError as e:
-            raise('Error connecting to Azure: %s' % e)
-        
-        icons = {}
-        tuples = []
-        pool = ThreadPool()       
-        func = partial(self._process_icon_hash, output_fn=output_fn)
-        try:
-            tuples = pool.map(func, blob_list)
-        except BaseException as err:
-            raise MakeCatalogsError('Error processing icon hashes: %s' % err)
-        
-        for name, icon_hash, error in tuples:
-            if error:
-                errors.append(error)
-            if name:
-                icons[name] = icon_hash    
-        
-        # get a list of pkgsinfo items
-        if output_fn:
-            output_fn("Getting list of pkgsinfo...")
-        try:
-            blob_list = self.container_client.list_blobs(name_starts_with='pkgsinfo')
-        except RepoError as err:
             raise MakeCatalogsError(
-                u"Error getting list of pkgsinfo items: %s" % err)
+                'Container icons not found. Please check the base url.')
+        except AzureError as e:
+            raise MakeCatalogsError('Error connecting to Azure: %s' % e)
 
-        # get a list of pkgs items
-        if output_fn:
-            output_fn("Getting list of pkgs...")
+        # load the hash cache from the previous run, if any
+        icon_cache_ref = os.path.join('icons', '_icon_hashes_cache.plist')
+        cached_hashes = {}
         try:
-            pkgs_list = self.itemlist('pkgs')
-        except RepoError as err:
-            raise MakeCatalogsError(
-                u"Error getting list of pkgs items: %s" % err)
+            with self._sem:
+                cache_data = self._blob_client(icon_cache_ref).download_blob().readall()
+            cached_hashes = plistlib.loads(cache_data)
+        except BaseException:
+            cached_hashes = {}
 
-        # start with empty catalogs dict
-        catalogs = {}
-        catalogs['all'] = []
-        
-        func = partial(self._process_pkgsinfo, output_fn=output_fn)
-        try:
-            tuples = pool.map(func, blob_list)
-        except BaseException as err:
-            raise MakeCatalogsError('Error processing pkgsinfo: %s' % err)
-
-        for pkginfo_ref, pkginfo, error in tuples:
-            if error:
-                errors.append(error)
-            if pkginfo:
-                # sanity checking
-                if not options.skip_payload_check:
-                    output_fn("Verifying %s..." % pkginfo_ref)
-                    verified = self._verify_pkginfo(pkginfo_ref, pkginfo, pkgs_list, errors)
-                    if not verified and not options.force:
-                        output_fn("Skipping %s..." % pkginfo_ref)
-                        # Skip this pkginfo unless we're running with force flag
-                        continue
-
-                output_fn("Adding %s to all..." % pkginfo_ref)
-                # append the pkginfo to the relevant catalogs
-                catalogs['all'].append(pkginfo)
-                for catalogname in pkginfo.get("catalogs", []):
-                    if not catalogname:
-                        errors.append("WARNING: %s has an empty catalogs array!"
-                                    % pkginfo_ref)
-                        continue
-                    
-                    if not catalogname in catalogs:
-                        catalogs[catalogname] = []
-                    catalogs[catalogname].append(pkginfo)
-                    if output_fn:
-                        output_fn("Adding %s to %s..." % (pkginfo_ref, catalogname))
-    
-                # look for catalog names that differ only in case
-                duplicate_catalogs = []
-                for key in catalogs:
-                    if key.lower() in [item.lower() for item in catalogs if item != key]:
-                        duplicate_catalogs.append(key)
-                if duplicate_catalogs:
-                    errors.append("WARNING: There are catalogs with names that differ only "
-                                "by case. This may cause issues depending on the case-"
-                                "sensitivity of the underlying filesystem: %s"
-                                % duplicate_catalogs)
-
-        # clear out old catalogs
-        try:
-            catalog_list = self.itemlist('catalogs')
-        except RepoError:
-            catalog_list = []
-        for catalog_name in catalog_list:
-            if catalog_name not in list(catalogs.keys()):
-                catalog_ref = os.path.join('catalogs', catalog_name)
-                try:
-                    output_fn("Deleting %s..." % catalog_ref)
-                    self.delete(catalog_ref)
-                except RepoError:
-                    errors.append('Could not delete catalog %s' % catalog_name)
-
-        # write the new catalogs
-        for key in catalogs:
-            catalogpath = os.path.join("catalogs", key)
-            if catalogs[key] != "":
-                catalog_data = writePlistToString(catalogs[key])
+        icons = {}
+        icon_cache = {}
+        # the workers are network-bound, so size the pool well beyond
+        # cpu_count; the with-block joins the worker threads on exit
+        # instead of leaking them
+        pool = ThreadPoolExecutor(max_workers=32)
+        with pool:
+            func = partial(self._process_icon_hash, cached_hashes=cached_hashes,
+                           output_fn=output_fn)
+            try:
+                futures = [pool.submit(func, blob) for blob in blob_list]
+                for future in as_completed(futures):
+                    name, icon_hash, etag, error = future.result()
+                    if error:
+                        errors.append(error)
+                    if name:
+                        icons[name] = icon_hash
+                        icon_cache[name] = {'sha256': icon_hash, 'etag': etag}
+            except BaseException as err:
+                raise MakeCatalogsError('Error processing icon hashes: %s' % err)
+
+            # get a list of pkgsinfo items
+            if output_fn:
+                output_fn("Getting list of pkgsinfo...")
+            try:
+                blob_list = self.container_client.list_blob_names(name_starts_with='pkgsinfo')
+            except RepoError as err:
+                raise MakeCatalogsError(
+                    u"Error getting list of pkgsinfo items: %s" % err)
+
+            # get a list of pkgs items
+            if output_fn:
+                output_fn("Getting list of pkgs...")
+            try:
+                pkgs_list = self.itemlist('pkgs')
+            except RepoError as err:
+                raise MakeCatalogsError(
+                    u"Error getting list of pkgs items: %s" % err)
+            # index the pkgs once so verification is a hash lookup instead
+            # of a linear scan per pkginfo
+            pkgs_set = set(pkgs_list)
+            pkgs_lower = {pkg.lower(): pkg for pkg in pkgs_list}
+
+            # start with empty catalogs dict
+            catalogs = {}
+            catalogs['all'] = []
+
+            # consume results as they complete so catalog bucketing and
+            # verification overlap with the remaining downloads, instead of
+            # holding every result until the slowest download finishes
+            func = partial(self._process_pkgsinfo, pkgs_set=pkgs_set,
+                           pkgs_lower=pkgs_lower, options=options,
+                           output_fn=output_fn)
+            try:
+                futures = [pool.submit(func, name) for name in blob_list]
+            except BaseException as err:
+                raise MakeCatalogsError('Error processing pkgsinfo: %s' % err)
+
+            # the workers download, parse, verify and serialize; all that is
+            # left here is merging errors and bucketing the fragments
+            for future in as_completed(futures):
+                pkginfo_ref, fragment, catalog_names, item_errors = future.result()
+                errors.extend(item_errors)
+                if fragment:
+                    output_fn("Adding %s to all..." % pkginfo_ref)
+                    # append the pkginfo fragment to the relevant catalogs
+                    catalogs['all'].append(fragment)
+                    for catalogname in catalog_names:
+                        if not catalogname:
+                            errors.append("WARNING: %s has an empty catalogs array!"
+                                        % pkginfo_ref)
+                            continue
+
+                        if not catalogname in catalogs:
+                            catalogs[catalogname] = []
+                        catalogs[catalogname].append(fragment)
+                        if output_fn:
+                            output_fn("Adding %s to %s..." % (pkginfo_ref, catalogname))
+
+            # look for catalog names that differ only in case -- one linear
+            # scan over the final catalog names instead of a nested scan per
+            # pkginfo
+            catalog_name_buckets = defaultdict(list)
+            for key in catalogs:
+                catalog_name_buckets[key.lower()].append(key)
+            duplicate_catalogs = [key for group in catalog_name_buckets.values()
+                                  if len(group) > 1 for key in group]
+            if duplicate_catalogs:
+                errors.append("WARNING: There are catalogs with names that differ only "
+                            "by case. This may cause issues depending on the case-"
+                            "sensitivity of the underlying filesystem: %s"
+                            % duplicate_catalogs)
+
+            # clear out old catalogs
+            # diff the existing catalog blob names against the catalogs we
+            # are about to write, then delete them via the batch API --
+            # one request per 256 blobs instead of one per blob
+            try:
+                existing_catalogs = set(
+                    self.container_client.list_blob_names(name_starts_with='catalogs/'))
+            except AzureError:
+                existing_catalogs = set()
+            stale_refs = sorted(
+                existing_catalogs -
+                set(os.path.join('catalogs', key) for key in catalogs))
+            if stale_refs:
+                if output_fn:
+                    for catalog_ref in stale_refs:
+                        output_fn("Deleting %s..." % catalog_ref)
                 try:
-                    self.put(catalogpath, catalog_data)
-                    if output_fn:
-                        output_fn("Created %s..." % catalogpath)
+                    self.delete_many(stale_refs)
                 except RepoError as err:
+                    errors.append('Could not delete stale catalogs: %s' % err)
+
+            # write the new catalogs, again in parallel since each put is a
+            # blocking upload
+            catalog_items = []
+            for key in catalogs:
+                catalogpath = os.path.join("catalogs", key)
+                if catalogs[key] != "":
+                    # stitch the catalog together from the pre-serialized
+                    # pkginfo fragments; SpooledTemporaryFile spills to disk
+                    # if a catalog outgrows the buffer, and upload_blob
+                    # streams the file object in parallel blocks
+                    buf = SpooledTemporaryFile(max_size=10 * 1024 * 1024)
+                    buf.write(PLIST_ARRAY_HEADER)
+                    for fragment in catalogs[key]:
+                        buf.write(fragment)
+                    buf.write(PLIST_ARRAY_FOOTER)
+                    buf.seek(0)
+                    catalog_items.append((catalogpath, buf))
+                else:
                     errors.append(
-                        u'Failed to create catalog %s: %s' % (key, err))
-            else:
-                errors.append(
-                    "WARNING: Did not create catalog %s because it is empty" % key)
+                        "WARNING: Did not create catalog %s because it is empty" % key)
+            try:
+                list(pool.map(
+                    lambda item: self.put(item[0], item[1]), catalog_items))
+                if output_fn:
+                    for catalogpath, _ in catalog_items:
+                        output_fn("Created %s..." % catalogpath)
+            except RepoError as err:
+                errors.append(u'Failed to create catalogs: %s' % err)
 
-        # write icon hashes to the repo                    
+        # write icon hashes to the repo
         if icons:
             icon_hashes_plist = os.path.join("icons", "_icon_hashes.plist")
             icon_hashes = writePlistToString(icons)
             try:
                 self.put(icon_hashes_plist, icon_hashes)
+                # the sidecar cache records the etag each hash was computed
+                # from, so the next run can skip unchanged icons
+                self.put(icon_cache_ref, writePlistToString(icon_cache))
                 output_fn("Created %s..." % (icon_hashes_plist))
             except RepoError as err:
                 errors.append(